@@ -1,7 +1,7 @@
 """Personal Accountant Agent Package"""
 from agent.graph import get_compiled_graph, create_default_state, calculate_snapshot
 from agent.state import AgentState, UserProfile, FinancialSnapshot, Transaction
-from agent.tools import TOOLS
+from agent.tools import TOOLS, TOOL_SCHEMAS
 
 __all__ = [
     "get_compiled_graph",
@@ -11,5 +11,6 @@ __all__ = [
     "UserProfile", 
     "FinancialSnapshot",
     "Transaction",
-    "TOOLS"
+    "TOOLS",
+    "TOOL_SCHEMAS"
 ]
@@ -1,9 +1,12 @@
 """LangGraph Agent for Personal Accountant"""
 import os
-import json
+import asyncio
 import re
+import time
 from datetime import datetime
-from typing import Dict, Any, List, Optional, Literal
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Any, List, Optional, Literal, Tuple, Callable
 from dotenv import load_dotenv
 
 from langgraph.graph import StateGraph, END
@@ -11,9 +14,15 @@ from langgraph.checkpoint.sqlite import SqliteSaver
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
 
 import httpx
+import orjson
 
 from agent.state import AgentState, UserProfile, FinancialSnapshot, Transaction, Account
-from agent.tools import TOOLS, add_transaction, update_balance, generate_report, export_csv, detect_anomalies, tax_estimate
+from agent.tools import TOOLS, TOOL_SCHEMAS, add_transaction, update_balance, generate_report, export_csv, detect_anomalies, tax_estimate
+
+TOOLS_BY_NAME = {tool.name: tool for tool in TOOLS}
+
+# Tools that only read their arguments; safe to run concurrently with each other
+READ_ONLY_TOOLS = {tool.name: tool for tool in (generate_report, export_csv, detect_anomalies, tax_estimate)}
 
 load_dotenv()
 
@@ -95,6 +104,27 @@ For questions and analysis, provide clear, actionable insights.
 - detect_anomalies: Find unusual spending patterns
 - tax_estimate: Calculate estimated tax liability"""
 
+# Snapshot of a ledger with nothing in it (read-only; copy before use)
+_EMPTY_SNAPSHOT = MappingProxyType({
+    "total_cash": 0.0,
+    "total_investments": 0.0,
+    "total_liabilities": 0.0,
+    "net_worth": 0.0,
+    "ytd_income": 0.0,
+    "ytd_expenses": 0.0,
+    "estimated_tax_liability": 0.0,
+    "monthly_burn_rate": 0.0
+})
+
+# Shared, never mutated: message lists only ever append it
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Conversation messages kept in state (and so in every saved checkpoint)
+MAX_MESSAGES = 200
+
+_DIGITS_RE = re.compile(r'\d+')
+_NON_NUMERIC_RE = re.compile(r'[^\d.]')
+
 SETUP_QUESTIONS = [
     "What's your tax residency? (e.g., US - California, UK, Canada - Ontario)",
     "What's your filing status? (Single, Married Filing Jointly, Married Filing Separately, Head of Household)",
@@ -107,23 +137,28 @@ SETUP_QUESTIONS = [
 ]
 
 
+@lru_cache(maxsize=1)
+def _year_month_at(minute: int) -> Tuple[int, int]:
+    now = datetime.now()
+    return now.year, now.month
+
+
+def _current_year_month() -> Tuple[int, int]:
+    """Local (year, month), re-read from the clock at most once a minute."""
+    return _year_month_at(int(time.time() // 60))
+
+
 def create_default_state() -> AgentState:
     """Create a fresh agent state with defaults."""
     return {
         "messages": [],
         "user_profile": None,
         "transactions": [],
+        "dirty_tx_ids": [],
         "accounts": {},
-        "snapshot": {
-            "total_cash": 0.0,
-            "total_investments": 0.0,
-            "total_liabilities": 0.0,
-            "net_worth": 0.0,
-            "ytd_income": 0.0,
-            "ytd_expenses": 0.0,
-            "estimated_tax_liability": 0.0,
-            "monthly_burn_rate": 0.0
-        },
+        "snapshot": dict(_EMPTY_SNAPSHOT),
+        "snapshot_dirty": False,
+        "snapshot_year": _current_year_month()[0],
         "pending_sync": [],
         "setup_step": 0,
         "thread_id": "",
@@ -131,6 +166,46 @@ def create_default_state() -> AgentState:
     }
 
 
+# Shared HTTP client so OpenRouter connections (and TLS sessions) are reused
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Get the pooled HTTP client, creating it on first use."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=60.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+            http2=True
+        )
+    return _http_client
+
+
+async def close_http_client():
+    """Stop the request batcher and close the pooled HTTP client (call on application shutdown)."""
+    global _http_client, _batch_worker, _batch_queue
+    # Cancelling the worker and in-flight batches cancels the callers' futures
+    tasks = list(_batches_in_flight)
+    if _batch_worker is not None:
+        tasks.append(_batch_worker)
+        _batch_worker = None
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    # Requests still queued never reached a batch
+    if _batch_queue is not None:
+        while not _batch_queue.empty():
+            _batch_queue.get_nowait()[2].cancel()
+        _batch_queue = None
+    
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
 async def call_openrouter(messages: List[Dict], tools: List[Dict] = None, model_index: int = 0) -> Dict:
     """Call OpenRouter API with fallback to alternative models."""
     if model_index >= len(MODELS):
@@ -156,82 +231,269 @@ async def call_openrouter(messages: List[Dict], tools: List[Dict] = None, model_
         payload["tools"] = tools
         payload["tool_choice"] = "auto"
     
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        try:
-            response = await client.post(
-                f"{OPENROUTER_BASE_URL}/chat/completions",
-                headers=headers,
-                json=payload
-            )
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            print(f"Model {model} failed: {e}, trying next...")
-            return await call_openrouter(messages, tools, model_index + 1)
+    try:
+        response = await _get_http_client().post(
+            f"{OPENROUTER_BASE_URL}/chat/completions",
+            headers=headers,
+            json=payload
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content)
+    except Exception as e:
+        print(f"Model {model} failed: {e}, trying next...")
+        return await call_openrouter(messages, tools, model_index + 1)
+
+
+# Requests arriving within the batch window are dispatched together over the
+# pooled client. Each is still its own HTTP call, so the window is pure added
+# latency unless dispatching in bursts matters; 0 (the default) disables it
+OPENROUTER_BATCH_WINDOW_MS = float(os.getenv("OPENROUTER_BATCH_WINDOW_MS", "0"))
+OPENROUTER_BATCH_SIZE = int(os.getenv("OPENROUTER_BATCH_SIZE", "8"))
+
+_batch_queue: Optional[asyncio.Queue] = None
+_batch_worker: Optional[asyncio.Task] = None
+_batches_in_flight: set = set()
+
+
+async def _dispatch_openrouter_batch(batch: List[tuple]):
+    """Send a batch of queued requests concurrently and resolve their futures."""
+    try:
+        results = await asyncio.gather(
+            *(call_openrouter(messages, tools) for messages, tools, _ in batch),
+            return_exceptions=True
+        )
+    except asyncio.CancelledError:
+        for _, _, future in batch:
+            future.cancel()
+        raise
+    for (_, _, future), result in zip(batch, results):
+        if future.done():  # caller went away
+            continue
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
 
 
-def format_tools_for_api() -> List[Dict]:
-    """Format LangChain tools for OpenRouter API."""
-    formatted = []
-    for tool in TOOLS:
-        formatted.append({
-            "type": "function",
-            "function": {
-                "name": tool.name,
-                "description": tool.description,
-                "parameters": tool.args_schema.schema() if hasattr(tool, 'args_schema') else {}
-            }
-        })
-    return formatted
+async def _openrouter_batch_loop(queue: asyncio.Queue):
+    """Drain queued requests into batches of up to OPENROUTER_BATCH_SIZE."""
+    while True:
+        batch = [await queue.get()]
+        try:
+            await asyncio.sleep(OPENROUTER_BATCH_WINDOW_MS / 1000)
+        except asyncio.CancelledError:
+            for _, _, future in batch:
+                future.cancel()
+            raise
+        while len(batch) < OPENROUTER_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+        
+        # Don't wait for the responses before collecting the next batch
+        task = asyncio.create_task(_dispatch_openrouter_batch(batch))
+        _batches_in_flight.add(task)
+        task.add_done_callback(_batches_in_flight.discard)
 
 
-def calculate_snapshot(state: AgentState) -> FinancialSnapshot:
-    """Calculate current financial snapshot from accounts and transactions."""
-    total_cash = 0.0
-    total_investments = 0.0
-    total_liabilities = 0.0
-    ytd_income = 0.0
-    ytd_expenses = 0.0
+async def _batched_call_openrouter(messages: List[Dict], tools: List[Dict] = None) -> Dict:
+    """Queue an OpenRouter request for the batcher and wait for its response."""
+    global _batch_queue, _batch_worker
+    if OPENROUTER_BATCH_WINDOW_MS <= 0:
+        return await call_openrouter(messages, tools)
     
-    current_year = datetime.now().year
-    
-    for name, account in state.get("accounts", {}).items():
-        if account["type"] == "asset":
-            if "invest" in name.lower() or "stock" in name.lower() or "crypto" in name.lower():
-                total_investments += account["balance"]
-            else:
-                total_cash += account["balance"]
-        elif account["type"] == "liability":
-            total_liabilities += account["balance"]
-    
-    for tx in state.get("transactions", []):
-        tx_date = datetime.fromisoformat(tx["timestamp"].replace("Z", ""))
-        if tx_date.year == current_year:
-            if tx["category"] == "income":
-                ytd_income += tx["amount"]
-            elif tx["category"] == "expense":
-                ytd_expenses += tx["amount"]
-    
-    net_worth = total_cash + total_investments - total_liabilities
+    loop = asyncio.get_running_loop()
+    if _batch_worker is None or _batch_worker.done() or _batch_worker.get_loop() is not loop:
+        _batch_queue = asyncio.Queue()
+        _batch_worker = loop.create_task(_openrouter_batch_loop(_batch_queue))
     
+    future = loop.create_future()
+    await _batch_queue.put((messages, tools, future))
+    return await future
+
+
+def format_tools_for_api() -> List[Dict]:
+    """Format LangChain tools for OpenRouter API.
+
+    The schemas are serialized once when agent.tools is imported; callers
+    must not mutate the returned list.
+    """
+    return TOOL_SCHEMAS
+
+
+_ASSET_CLASS_TOTALS = {
+    "cash": "total_cash",
+    "investment": "total_investments",
+    "liability": "total_liabilities"
+}
+
+
+def _classify_account(name: str, account_type: str) -> str:
+    """Classify an account for the snapshot totals (done once, on creation)."""
+    if account_type == "asset":
+        lname = name.lower()
+        return "investment" if any(k in lname for k in ("invest", "stock", "crypto")) else "cash"
+    if account_type == "liability":
+        return "liability"
+    return "other"
+
+
+def _account_bucket(name: str, account: Account) -> Optional[str]:
+    """Return the snapshot total an account's balance counts towards, if any."""
+    asset_class = account.get("asset_class")
+    if asset_class is None:
+        # Accounts saved before classification was stored, or merged via sync
+        asset_class = account["asset_class"] = _classify_account(name, account["type"])
+    return _ASSET_CLASS_TOTALS.get(asset_class)
+
+
+def _apply_balance_delta(snapshot: FinancialSnapshot, name: str, account: Account, delta: float):
+    """Adjust the running account totals for a change in one account's balance."""
+    bucket = _account_bucket(name, account)
+    if bucket:
+        snapshot[bucket] += delta
+
+
+def _transaction_year(tx: Transaction) -> int:
+    """Calendar year of a transaction, parsed from its ISO timestamp once and cached on it."""
+    year = tx.get("_year")
+    if year is None:
+        year = tx["_year"] = int(tx["timestamp"][:4])
+    return year
+
+
+def _apply_tx_delta(snapshot: FinancialSnapshot, tx: Transaction, current_year: int):
+    """Adjust the running YTD totals for a newly recorded transaction."""
+    if _transaction_year(tx) == current_year:
+        if tx["category"] == "income":
+            snapshot["ytd_income"] += tx["amount"]
+        elif tx["category"] == "expense":
+            snapshot["ytd_expenses"] += tx["amount"]
+
+
+def _finalize_snapshot(snapshot: FinancialSnapshot, current_month: int) -> FinancialSnapshot:
+    """Derive net worth, tax estimate and burn rate from the running totals."""
+    snapshot["net_worth"] = snapshot["total_cash"] + snapshot["total_investments"] - snapshot["total_liabilities"]
+
     # Simple tax estimate (simplified)
-    taxable_income = ytd_income - ytd_expenses * 0.1  # Simplified deduction
-    estimated_tax = taxable_income * 0.22 if taxable_income > 0 else 0  # Simplified 22% bracket
-    
+    taxable_income = snapshot["ytd_income"] - snapshot["ytd_expenses"] * 0.1  # Simplified deduction
+    snapshot["estimated_tax_liability"] = taxable_income * 0.22 if taxable_income > 0 else 0  # Simplified 22% bracket
+
     # Monthly burn rate
-    months_elapsed = max(1, datetime.now().month)
-    monthly_burn = ytd_expenses / months_elapsed
-    
-    return {
-        "total_cash": total_cash,
-        "total_investments": total_investments,
-        "total_liabilities": total_liabilities,
-        "net_worth": net_worth,
-        "ytd_income": ytd_income,
-        "ytd_expenses": ytd_expenses,
-        "estimated_tax_liability": estimated_tax,
-        "monthly_burn_rate": monthly_burn
-    }
+    months_elapsed = max(1, current_month)
+    snapshot["monthly_burn_rate"] = snapshot["ytd_expenses"] / months_elapsed
+    return snapshot
+
+
+def _rebuild_snapshot(
+    state: AgentState,
+    current_year: int,
+    ytd_totals: Optional[Callable[[int], Tuple[float, float]]] = None
+) -> FinancialSnapshot:
+    """Recompute the running totals from every account and transaction."""
+    snapshot = dict(_EMPTY_SNAPSHOT)
+
+    for name, account in state.get("accounts", {}).items():
+        _apply_balance_delta(snapshot, name, account, account["balance"])
+
+    if ytd_totals is not None:
+        snapshot["ytd_income"], snapshot["ytd_expenses"] = ytd_totals(current_year)
+        return snapshot
+
+    # Filter the year's transactions in one pass, then total each category
+    ytd_txs = [tx for tx in state.get("transactions", []) if _transaction_year(tx) == current_year]
+    snapshot["ytd_income"] = sum((tx["amount"] for tx in ytd_txs if tx["category"] == "income"), 0.0)
+    snapshot["ytd_expenses"] = sum((tx["amount"] for tx in ytd_txs if tx["category"] == "expense"), 0.0)
+
+    return snapshot
+
+
+def calculate_snapshot(
+    state: AgentState,
+    ytd_totals: Optional[Callable[[int], Tuple[float, float]]] = None
+) -> FinancialSnapshot:
+    """Return the current financial snapshot for a state.
+
+    The running totals in ``state["snapshot"]`` are kept up to date as
+    transactions and balances change, so normally only the derived fields
+    are refreshed. A full rebuild from accounts and transactions happens when
+    the state is flagged dirty (or predates the flag) or the year rolled over.
+
+    ``ytd_totals``, if given, maps a year to its (income, expenses) totals
+    and replaces the scan over ``state["transactions"]`` during a rebuild
+    (e.g. an indexed SQL aggregate).
+    """
+    current_year, current_month = _current_year_month()
+
+    if not state.get("transactions") and not state.get("accounts"):
+        # Nothing recorded yet (e.g. during onboarding): every total is zero
+        snapshot = state["snapshot"] = dict(_EMPTY_SNAPSHOT)
+        state["snapshot_dirty"] = False
+        state["snapshot_year"] = current_year
+        return snapshot
+
+    snapshot = state.get("snapshot")
+
+    if not snapshot or state.get("snapshot_dirty", True) or state.get("snapshot_year") != current_year:
+        snapshot = _rebuild_snapshot(state, current_year, ytd_totals)
+        state["snapshot"] = snapshot
+        state["snapshot_dirty"] = False
+        state["snapshot_year"] = current_year
+
+    return _finalize_snapshot(snapshot, current_month)
+
+
+def _set_tax_residency(profile: UserProfile, answer: str):
+    profile["tax_residency"] = answer
+
+
+def _set_filing_status(profile: UserProfile, answer: str):
+    profile["filing_status"] = answer
+
+
+def _set_dependents(profile: UserProfile, answer: str):
+    try:
+        match = _DIGITS_RE.search(answer)
+        profile["dependents"] = int(match.group()) if match else 0
+    except:
+        profile["dependents"] = 0
+
+
+def _set_income_sources(profile: UserProfile, answer: str):
+    profile["income_sources"] = [s.strip() for s in answer.split(",")]
+
+
+def _set_income_estimate(profile: UserProfile, answer: str):
+    try:
+        # Extract number from answer
+        num = _NON_NUMERIC_RE.sub('', answer)
+        profile["annual_income_estimate"] = float(num) if num else 0.0
+    except:
+        profile["annual_income_estimate"] = 0.0
+
+
+def _set_retirement_accounts(profile: UserProfile, answer: str):
+    profile["retirement_accounts"] = [s.strip() for s in answer.split(",")]
+
+
+def _set_investment_accounts(profile: UserProfile, answer: str):
+    profile["investment_accounts"] = [s.strip() for s in answer.split(",")]
+
+
+def _set_primary_bank(profile: UserProfile, answer: str):
+    profile["primary_bank"] = answer
+    profile["setup_complete"] = True
+
+
+# Answer parsers, indexed by setup step (one per entry in SETUP_QUESTIONS)
+_SETUP_HANDLERS = (
+    _set_tax_residency,
+    _set_filing_status,
+    _set_dependents,
+    _set_income_sources,
+    _set_income_estimate,
+    _set_retirement_accounts,
+    _set_investment_accounts,
+    _set_primary_bank
+)
 
 
 async def handle_setup(state: AgentState) -> AgentState:
@@ -258,31 +520,7 @@ async def handle_setup(state: AgentState) -> AgentState:
             answer = messages[-1].get("content", "")
             
             # Parse and store based on step
-            if setup_step == 0:
-                user_profile["tax_residency"] = answer
-            elif setup_step == 1:
-                user_profile["filing_status"] = answer
-            elif setup_step == 2:
-                try:
-                    user_profile["dependents"] = int(re.search(r'\d+', answer).group()) if re.search(r'\d+', answer) else 0
-                except:
-                    user_profile["dependents"] = 0
-            elif setup_step == 3:
-                user_profile["income_sources"] = [s.strip() for s in answer.split(",")]
-            elif setup_step == 4:
-                try:
-                    # Extract number from answer
-                    num = re.sub(r'[^\d.]', '', answer)
-                    user_profile["annual_income_estimate"] = float(num) if num else 0.0
-                except:
-                    user_profile["annual_income_estimate"] = 0.0
-            elif setup_step == 5:
-                user_profile["retirement_accounts"] = [s.strip() for s in answer.split(",")]
-            elif setup_step == 6:
-                user_profile["investment_accounts"] = [s.strip() for s in answer.split(",")]
-            elif setup_step == 7:
-                user_profile["primary_bank"] = answer
-                user_profile["setup_complete"] = True
+            _SETUP_HANDLERS[setup_step](user_profile, answer)
             
             state["user_profile"] = user_profile
             state["setup_step"] = setup_step + 1
@@ -305,32 +543,109 @@ async def handle_setup(state: AgentState) -> AgentState:
                 "content": f"👋 Welcome to your Personal Accountant! Let me set up your profile.\n\n{SETUP_QUESTIONS[0]}"
             })
     
+    del messages[:-MAX_MESSAGES]
     state["messages"] = messages
     return state
 
 
+def _parse_tool_args(tool_call: Dict) -> Optional[Dict[str, Any]]:
+    """Parse and validate a tool call's JSON arguments in a single pydantic pass.
+
+    Returns None for tools we don't know about.
+    """
+    tool = TOOLS_BY_NAME.get(tool_call["function"]["name"])
+    if tool is None:
+        return None
+    return tool.args_schema.model_validate_json(tool_call["function"]["arguments"]).model_dump()
+
+
+def public_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy of a transaction or account without the agent's own bookkeeping.
+
+    Drops the cached ``_display``/``_year`` keys and the snapshot
+    ``asset_class``, which must not reach the model, clients, or come back
+    from them.
+    """
+    return {k: v for k, v in record.items() if not k.startswith("_") and k != "asset_class"}
+
+
+def _tool_message_content(result: Any) -> str:
+    """Serialize a tool result for the model, with its records made public."""
+    if isinstance(result, dict):
+        result = {k: public_record(v) if k in ("transaction", "account") and isinstance(v, dict) else v
+                  for k, v in result.items()}
+    return orjson.dumps(result).decode()
+
+
+def _transaction_line(tx: Transaction) -> str:
+    """Context line for a transaction, formatted once and cached on it."""
+    line = tx.get("_display")
+    if line is None:
+        line = tx["_display"] = f"- {tx['timestamp'][:10]}: {tx['description']} - ${tx['amount']:,.2f}"
+    return line
+
+
+def _account_line(name: str, acc: Account) -> str:
+    """Context line for an account, cached until its balance changes."""
+    line = acc.get("_display")
+    if line is None:
+        line = acc["_display"] = f"- {name}: ${acc['balance']:,.2f} ({acc['type']})"
+    return line
+
+
+@lru_cache(maxsize=128)
+def _build_profile_message(
+    tax_residency: str,
+    filing_status: str,
+    dependents: int,
+    income_sources: tuple,
+    annual_income_estimate: float,
+    retirement_accounts: tuple,
+    investment_accounts: tuple,
+    primary_bank: str
+) -> Dict[str, str]:
+    """Build the (shared, never mutated) system message describing a profile."""
+    profile_context = f"""
+USER PROFILE:
+- Tax Residency: {tax_residency}
+- Filing Status: {filing_status}
+- Dependents: {dependents}
+- Income Sources: {', '.join(income_sources)}
+- Annual Income Estimate: ${annual_income_estimate:,.2f}
+- Retirement Accounts: {', '.join(retirement_accounts)}
+- Investment Accounts: {', '.join(investment_accounts)}
+- Primary Bank: {primary_bank}
+"""
+    return {"role": "system", "content": profile_context}
+
+
+def _profile_message(profile: UserProfile) -> Dict[str, str]:
+    """Get the profile context message, reused while the profile is unchanged."""
+    return _build_profile_message(
+        profile.get('tax_residency', 'Unknown'),
+        profile.get('filing_status', 'Unknown'),
+        profile.get('dependents', 0),
+        tuple(profile.get('income_sources', [])),
+        profile.get('annual_income_estimate', 0),
+        tuple(profile.get('retirement_accounts', [])),
+        tuple(profile.get('investment_accounts', [])),
+        profile.get('primary_bank', 'Unknown')
+    )
+
+
 async def process_message(state: AgentState) -> AgentState:
     """Process user message with LLM and tools."""
     messages = state.get("messages", [])
     
-    # Build context for LLM
-    api_messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    # Build context for LLM: a static prefix (instructions + profile), the
+    # ledger context, then the conversation history
+    static_prefix = [_SYSTEM_MESSAGE]
+    ledger_context = []
+    history = []
     
     # Add user profile context
     if state.get("user_profile"):
-        profile = state["user_profile"]
-        profile_context = f"""
-USER PROFILE:
-- Tax Residency: {profile.get('tax_residency', 'Unknown')}
-- Filing Status: {profile.get('filing_status', 'Unknown')}
-- Dependents: {profile.get('dependents', 0)}
-- Income Sources: {', '.join(profile.get('income_sources', []))}
-- Annual Income Estimate: ${profile.get('annual_income_estimate', 0):,.2f}
-- Retirement Accounts: {', '.join(profile.get('retirement_accounts', []))}
-- Investment Accounts: {', '.join(profile.get('investment_accounts', []))}
-- Primary Bank: {profile.get('primary_bank', 'Unknown')}
-"""
-        api_messages.append({"role": "system", "content": profile_context})
+        static_prefix.append(_profile_message(state["user_profile"]))
     
     # Add current snapshot context
     snapshot = calculate_snapshot(state)
@@ -346,26 +661,24 @@ CURRENT SNAPSHOT:
 - Est. Tax Liability: ${snapshot['estimated_tax_liability']:,.2f}
 - Monthly Burn Rate: ${snapshot['monthly_burn_rate']:,.2f}
 """
-    api_messages.append({"role": "system", "content": snapshot_context})
+    ledger_context.append({"role": "system", "content": snapshot_context})
     
     # Add accounts context
     if state.get("accounts"):
-        accounts_list = "\n".join([f"- {name}: ${acc['balance']:,.2f} ({acc['type']})" 
-                                   for name, acc in state["accounts"].items()])
-        api_messages.append({"role": "system", "content": f"ACCOUNTS:\n{accounts_list}"})
+        accounts_list = "\n".join(_account_line(name, acc) for name, acc in state["accounts"].items())
+        ledger_context.append({"role": "system", "content": f"ACCOUNTS:\n{accounts_list}"})
     
     # Add recent transactions
     recent_txs = state.get("transactions", [])[-10:]
     if recent_txs:
-        tx_list = "\n".join([f"- {tx['timestamp'][:10]}: {tx['description']} - ${tx['amount']:,.2f}" 
-                            for tx in recent_txs])
-        api_messages.append({"role": "system", "content": f"RECENT TRANSACTIONS:\n{tx_list}"})
+        tx_list = "\n".join(_transaction_line(tx) for tx in recent_txs)
+        ledger_context.append({"role": "system", "content": f"RECENT TRANSACTIONS:\n{tx_list}"})
     
     # Add conversation history (handle image messages for vision)
     for msg in messages[-20:]:  # Last 20 messages for context
         if msg.get("image"):
             # Vision message with image
-            api_messages.append({
+            history.append({
                 "role": msg["role"],
                 "content": [
                     {"type": "text", "text": msg["content"]},
@@ -378,11 +691,12 @@ CURRENT SNAPSHOT:
                 ]
             })
         else:
-            api_messages.append({"role": msg["role"], "content": msg["content"]})
+            history.append({"role": msg["role"], "content": msg["content"]})
     
     # Call LLM
+    api_messages = static_prefix + ledger_context + history
     tools = format_tools_for_api()
-    response = await call_openrouter(api_messages, tools)
+    response = await _batched_call_openrouter(api_messages, tools)
     
     # Process response
     choice = response.get("choices", [{}])[0]
@@ -390,17 +704,35 @@ CURRENT SNAPSHOT:
     
     # Handle tool calls
     if message.get("tool_calls"):
-        for tool_call in message["tool_calls"]:
+        tool_calls = message["tool_calls"]
+        call_args = [_parse_tool_args(tool_call) for tool_call in tool_calls]
+        results: List[Any] = [None] * len(tool_calls)
+        ledger_changed = False
+        
+        # Read-only tools don't touch the ledger, so run them concurrently
+        read_only = [i for i, tool_call in enumerate(tool_calls)
+                     if tool_call["function"]["name"] in READ_ONLY_TOOLS]
+        read_only_results = await asyncio.gather(*(
+            asyncio.to_thread(READ_ONLY_TOOLS[tool_calls[i]["function"]["name"]].func, **call_args[i])
+            for i in read_only
+        ))
+        for i, result in zip(read_only, read_only_results):
+            results[i] = result
+        
+        # Ledger updates are applied one at a time, in the order they were issued
+        for i, tool_call in enumerate(tool_calls):
             func_name = tool_call["function"]["name"]
-            func_args = json.loads(tool_call["function"]["arguments"])
+            func_args = call_args[i]
             
-            # Execute tool
-            result = None
             if func_name == "add_transaction":
-                result = add_transaction.invoke(func_args)
+                result = results[i] = add_transaction.func(**func_args)
                 if result.get("success"):
+                    ledger_changed = True
                     tx = result["transaction"]
+                    _transaction_line(tx)
                     state["transactions"].append(tx)
+                    state.setdefault("dirty_tx_ids", []).append(tx["id"])
+                    _apply_tx_delta(snapshot, tx, state["snapshot_year"])
                     
                     # Update accounts
                     from_acc = func_args["account_from"]
@@ -408,47 +740,57 @@ CURRENT SNAPSHOT:
                     amount = func_args["amount"]
                     
                     if from_acc not in state["accounts"]:
-                        state["accounts"][from_acc] = {"name": from_acc, "type": "asset", "balance": 0, "currency": "USD"}
+                        state["accounts"][from_acc] = {"name": from_acc, "type": "asset", "balance": 0, "currency": "USD",
+                                                       "asset_class": _classify_account(from_acc, "asset")}
                     if to_acc not in state["accounts"]:
                         acc_type = "expense" if func_args.get("category") == "expense" else "asset"
-                        state["accounts"][to_acc] = {"name": to_acc, "type": acc_type, "balance": 0, "currency": "USD"}
+                        state["accounts"][to_acc] = {"name": to_acc, "type": acc_type, "balance": 0, "currency": "USD",
+                                                     "asset_class": _classify_account(to_acc, acc_type)}
                     
                     state["accounts"][from_acc]["balance"] -= amount
                     state["accounts"][to_acc]["balance"] += amount
+                    state["accounts"][from_acc].pop("_display", None)
+                    state["accounts"][to_acc].pop("_display", None)
+                    _apply_balance_delta(snapshot, from_acc, state["accounts"][from_acc], -amount)
+                    _apply_balance_delta(snapshot, to_acc, state["accounts"][to_acc], amount)
                     
             elif func_name == "update_balance":
-                result = update_balance.invoke(func_args)
+                result = results[i] = update_balance.func(**func_args)
                 if result.get("success"):
+                    ledger_changed = True
                     acc = result["account"]
+                    acc["asset_class"] = _classify_account(acc["name"], acc["type"])
+                    previous = state["accounts"].get(acc["name"])
+                    if previous:
+                        _apply_balance_delta(snapshot, acc["name"], previous, -previous["balance"])
                     state["accounts"][acc["name"]] = acc
-                    
-            elif func_name == "generate_report":
-                result = generate_report.invoke(func_args)
-            elif func_name == "export_csv":
-                result = export_csv.invoke(func_args)
-            elif func_name == "detect_anomalies":
-                result = detect_anomalies.invoke(func_args)
-            elif func_name == "tax_estimate":
-                result = tax_estimate.invoke(func_args)
+                    _apply_balance_delta(snapshot, acc["name"], acc, acc["balance"])
+        
+        # Get final response after tool execution. The model only needs to
+        # confirm what the tools did, so send just the instructions, the
+        # current user turn, its tool calls and their results; the profile,
+        # ledger context (stale by now) and older history are left out.
+        if any(result is not None for result in results):
+            followup_messages = [_SYSTEM_MESSAGE, *history[-1:], message]
+            for tool_call, result in zip(tool_calls, results):
+                followup_messages.append({
+                    "role": "tool",
+                    "tool_call_id": tool_call["id"],
+                    "content": _tool_message_content(result)
+                })
             
-            # Add tool result to context
-            api_messages.append(message)
-            api_messages.append({
-                "role": "tool",
-                "tool_call_id": tool_call["id"],
-                "content": json.dumps(result)
-            })
+            response = await _batched_call_openrouter(followup_messages)
+            message = response.get("choices", [{}])[0].get("message", {})
         
-        # Get final response after tool execution
-        response = await call_openrouter(api_messages)
-        message = response.get("choices", [{}])[0].get("message", {})
+        # The tool branches adjusted the running totals in place; only the
+        # derived fields need refreshing
+        if ledger_changed:
+            _finalize_snapshot(snapshot, _current_year_month()[1])
     
-    # Add assistant response
-    assistant_content = message.get("content", "I apologize, but I couldn't process that. Could you rephrase?")
+    # Add assistant response (content is null when the model only issued tool calls)
+    assistant_content = message.get("content") or "I apologize, but I couldn't process that. Could you rephrase?"
     
     # Append snapshot to response
-    snapshot = calculate_snapshot(state)
-    state["snapshot"] = snapshot
     snapshot_display = f"\n\n💰 Cash: ${snapshot['total_cash']:,.2f} | 📈 Investments: ${snapshot['total_investments']:,.2f} | 📊 Net Worth: ${snapshot['net_worth']:,.2f}\n📅 YTD: Income ${snapshot['ytd_income']:,.2f} / Expenses ${snapshot['ytd_expenses']:,.2f} | 🏛️ Est. Tax: ${snapshot['estimated_tax_liability']:,.2f}"
     
     messages.append({
@@ -456,6 +798,7 @@ CURRENT SNAPSHOT:
         "content": assistant_content + snapshot_display
     })
     
+    del messages[:-MAX_MESSAGES]
     state["messages"] = messages
     state["last_updated"] = datetime.utcnow().isoformat()
     
@@ -502,6 +845,17 @@ from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 _checkpointer = None
 _compiled_graph = None
 
+# Checkpoints are written every turn; WAL with synchronous=NORMAL avoids an
+# fsync per commit while staying crash-safe
+CHECKPOINT_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",  # 64 MiB
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256 MiB
+    "PRAGMA wal_autocheckpoint=1000"
+]
+
 async def get_checkpointer():
     """Get async SQLite checkpointer for persistence."""
     global _checkpointer
@@ -509,10 +863,22 @@ async def get_checkpointer():
         checkpoint_path = os.getenv("CHECKPOINT_PATH", "./data/checkpoints.db")
         os.makedirs(os.path.dirname(checkpoint_path) if os.path.dirname(checkpoint_path) else ".", exist_ok=True)
         conn = await aiosqlite.connect(checkpoint_path)
+        for pragma in CHECKPOINT_PRAGMAS:
+            await conn.execute(pragma)
         _checkpointer = AsyncSqliteSaver(conn)
     return _checkpointer
 
 
+async def close_checkpointer():
+    """Optimize and close the checkpointer database (call on application shutdown)."""
+    global _checkpointer, _compiled_graph
+    if _checkpointer is not None:
+        await _checkpointer.conn.execute("PRAGMA optimize")
+        await _checkpointer.conn.close()
+        _checkpointer = None
+        _compiled_graph = None
+
+
 async def get_compiled_graph():
     """Get or create the compiled graph."""
     global _compiled_graph
@@ -15,7 +15,6 @@ class Transaction(TypedDict):
     cost_basis: Optional[float]
     asset_type: Optional[str]
     quantity: Optional[float]
-    encrypted_data: Optional[str]
 
 
 class Account(TypedDict):
@@ -23,6 +22,7 @@ class Account(TypedDict):
     type: str  # asset, liability, income, expense, equity
     balance: float
     currency: str
+    asset_class: str  # cash, investment, liability, other (set on creation)
 
 
 class UserProfile(TypedDict):
@@ -52,8 +52,11 @@ class AgentState(TypedDict):
     messages: List[Dict[str, Any]]
     user_profile: Optional[UserProfile]
     transactions: List[Transaction]
+    dirty_tx_ids: List[str]  # transactions not yet written to the transactions table
     accounts: Dict[str, Account]
     snapshot: FinancialSnapshot
+    snapshot_dirty: bool  # snapshot totals must be rebuilt from scratch
+    snapshot_year: int  # calendar year the snapshot's YTD totals cover
     pending_sync: List[Transaction]
     setup_step: int
     thread_id: str
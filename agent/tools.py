@@ -101,16 +101,17 @@ def generate_report(
     Returns:
         Report data
     """
+    now = datetime.utcnow()
     if not start_date:
         start_date = datetime(datetime.now().year, 1, 1).isoformat()
     if not end_date:
-        end_date = datetime.utcnow().isoformat()
+        end_date = now.isoformat()
     
     return {
         "success": True,
         "report_type": report_type,
         "period": {"start": start_date, "end": end_date},
-        "generated_at": datetime.utcnow().isoformat()
+        "generated_at": now.isoformat()
     }
 
 
@@ -197,3 +198,16 @@ TOOLS = [
     detect_anomalies,
     tax_estimate
 ]
+
+# OpenRouter/OpenAI function-calling schemas, serialized once at import
+TOOL_SCHEMAS = [
+    {
+        "type": "function",
+        "function": {
+            "name": t.name,
+            "description": t.description,
+            "parameters": t.args_schema.schema() if hasattr(t, 'args_schema') else {}
+        }
+    }
+    for t in TOOLS
+]
@@ -1,25 +1,33 @@
 """FastAPI Backend for Personal Accountant"""
 import os
-import json
 import csv
+import asyncio
 import io
 import sqlite3
 import base64
+import time
+import queue
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from typing import Optional, List, Dict, Any
-from contextlib import asynccontextmanager
+from typing import Optional, List, Dict, Any, Tuple, Union, Callable
+from contextlib import asynccontextmanager, contextmanager
 
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse
 from pydantic import BaseModel
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from dotenv import load_dotenv
+import orjson
 
 import sys
 sys.path.insert(0, '/app')
 
-from agent.graph import get_compiled_graph, create_default_state, calculate_snapshot
+from agent.graph import get_compiled_graph, create_default_state, calculate_snapshot, close_http_client, close_checkpointer, public_record
 from agent.state import AgentState
 
 load_dotenv()
@@ -27,65 +35,238 @@ load_dotenv()
 # Encryption setup
 FERNET_KEY = os.getenv("FERNET_KEY")
 if FERNET_KEY:
-    fernet = Fernet(FERNET_KEY.encode() if isinstance(FERNET_KEY, str) else FERNET_KEY)
+    _key = FERNET_KEY.encode() if isinstance(FERNET_KEY, str) else FERNET_KEY
+    # Fernet only decrypts rows written before the switch to AES-GCM
+    fernet = Fernet(_key)
+    aesgcm = AESGCM(HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b"cpa-state-aesgcm"
+    ).derive(base64.urlsafe_b64decode(_key)))
 else:
     fernet = None
+    aesgcm = None
 
 DATABASE_PATH = os.getenv("DATABASE_PATH", "./data/accountant.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "128"))
+
+
+def _dumps(obj: Any) -> str:
+    """Serialize to a JSON string with orjson."""
+    return orjson.dumps(obj).decode()
+
+
+_loads = orjson.loads
+
+
+def _connect() -> sqlite3.Connection:
+    """Open a database connection with per-connection tuning applied."""
+    # Pooled connections are handed between threadpool workers, one at a time
+    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+    # Safe under WAL: a crash can lose the last commits but never corrupts
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # 64 MiB page cache, kept warm for the lifetime of the pooled connection
+    conn.execute("PRAGMA cache_size=-65536")
+    # Read pages straight from the OS page cache (up to 256 MiB mapped)
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+
+_db_pool: Optional[queue.Queue] = None
+_db_pool_lock = threading.Lock()
+
+
+def _get_db_pool() -> queue.Queue:
+    """Get or lazily create the shared connection pool."""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                pool = queue.Queue(maxsize=DB_POOL_SIZE)
+                for _ in range(DB_POOL_SIZE):
+                    pool.put(_connect())
+                _db_pool = pool
+    return _db_pool
+
+
+@contextmanager
+def get_db():
+    """Borrow a long-lived connection from the pool for the duration of a block."""
+    pool = _get_db_pool()
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        # Never hand a half-finished transaction to the next borrower
+        if conn.in_transaction:
+            conn.rollback()
+        pool.put(conn)
+
+
+def close_db_pool():
+    """Close every pooled connection (call on shutdown)."""
+    global _db_pool
+    with _db_pool_lock:
+        pool, _db_pool = _db_pool, None
+    if pool is None:
+        return
+    while True:
+        try:
+            pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+
+# Hot-path statements, kept as constants so each call reuses the prepared
+# statement cached on the (long-lived) pooled connection
+SQL_UPSERT_SESSION = """
+    INSERT OR REPLACE INTO sessions (thread_id, state_data, snapshot_data, created_at, updated_at)
+    VALUES (?, ?, ?, COALESCE((SELECT created_at FROM sessions WHERE thread_id = ?), ?), ?)
+"""
+
+SQL_UPSERT_TRANSACTION = """
+    INSERT OR REPLACE INTO transactions 
+    (id, thread_id, timestamp, description, amount, account_from, account_to, 
+     category, subcategory, cost_basis, asset_type, quantity)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_INSERT_TRANSACTION_IGNORE = """
+    INSERT OR IGNORE INTO transactions 
+    (id, thread_id, timestamp, description, amount, account_from, account_to, 
+     category, subcategory, cost_basis, asset_type, quantity)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_UPSERT_ACCOUNT = """
+    INSERT OR REPLACE INTO accounts (thread_id, name, type, balance, currency)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+SQL_COUNT_TRANSACTIONS = "SELECT COUNT(*) FROM transactions WHERE thread_id = ?"
+
+SQL_YTD_TOTALS = """
+    SELECT category, TOTAL(amount)
+    FROM transactions 
+    WHERE thread_id = ? AND category IN ('income', 'expense')
+      AND timestamp >= ? AND timestamp < ?
+    GROUP BY category
+"""
+
+SQL_SELECT_SESSION_SUMMARY = "SELECT snapshot_data FROM sessions WHERE thread_id = ?"
+SQL_SELECT_SESSION_UPDATED_AT = "SELECT updated_at FROM sessions WHERE thread_id = ?"
+SQL_SELECT_SESSION_STATE = "SELECT state_data FROM sessions WHERE thread_id = ?"
+
+_SQL_SELECT_TRANSACTIONS_PAGE = """
+    SELECT id, timestamp, description, amount, account_from, account_to, 
+           category, subcategory, cost_basis, asset_type, quantity
+    FROM transactions 
+    WHERE {where}
+    ORDER BY timestamp DESC, id DESC
+    {paging}
+"""
+SQL_SELECT_TRANSACTIONS_PAGE = _SQL_SELECT_TRANSACTIONS_PAGE.format(
+    where="thread_id = ?", paging="LIMIT ? OFFSET ?")
+# Keyset variants resume from their key; an OFFSET would skip rows past it
+SQL_SELECT_TRANSACTIONS_BEFORE_TS = _SQL_SELECT_TRANSACTIONS_PAGE.format(
+    where="thread_id = ? AND timestamp < ?", paging="LIMIT ?")
+SQL_SELECT_TRANSACTIONS_AFTER_CURSOR = _SQL_SELECT_TRANSACTIONS_PAGE.format(
+    where="thread_id = ? AND (timestamp, id) < (?, ?)", paging="LIMIT ?")
+
+SQL_EXPORT_TRANSACTIONS = """
+    SELECT id, timestamp, description, amount, account_from, account_to, 
+           category, subcategory, cost_basis, asset_type, quantity
+    FROM transactions 
+    WHERE thread_id = ?
+    ORDER BY timestamp DESC
+"""
+
+# Plain date bounds (rather than strftime on the column) keep the
+# (thread_id, timestamp, id) index usable
+SQL_MONTHLY_TOTALS = """
+    SELECT 
+        CAST(strftime('%m', timestamp) AS INTEGER) as month,
+        SUM(CASE WHEN category = 'income' THEN amount ELSE 0 END) as income,
+        SUM(CASE WHEN category = 'expense' THEN amount ELSE 0 END) as expenses
+    FROM transactions 
+    WHERE thread_id = ? AND timestamp >= ? AND timestamp < ?
+    GROUP BY month
+"""
+
+
+def _add_column_if_missing(cursor: sqlite3.Cursor, table: str, column: str, decl: str):
+    """Add a column to a table created before the column existed."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
 
 
 def init_db():
     """Initialize SQLite database."""
     os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    # User sessions table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS sessions (
-            thread_id TEXT PRIMARY KEY,
-            state_data TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            updated_at TEXT NOT NULL
-        )
-    """)
-    
-    # Transactions table (for querying)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS transactions (
-            id TEXT PRIMARY KEY,
-            thread_id TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            description TEXT NOT NULL,
-            amount REAL NOT NULL,
-            account_from TEXT NOT NULL,
-            account_to TEXT NOT NULL,
-            category TEXT NOT NULL,
-            subcategory TEXT,
-            cost_basis REAL,
-            asset_type TEXT,
-            quantity REAL,
-            encrypted_data TEXT,
-            FOREIGN KEY (thread_id) REFERENCES sessions(thread_id)
-        )
-    """)
-    
-    # Accounts table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS accounts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            thread_id TEXT NOT NULL,
-            name TEXT NOT NULL,
-            type TEXT NOT NULL,
-            balance REAL NOT NULL,
-            currency TEXT DEFAULT 'USD',
-            FOREIGN KEY (thread_id) REFERENCES sessions(thread_id),
-            UNIQUE(thread_id, name)
-        )
-    """)
+    with get_db() as conn:
+        cursor = conn.cursor()
+        
+        # Write-ahead logging (persistent): readers don't block the writer, and
+        # commits append to the log instead of rewriting pages
+        cursor.execute("PRAGMA journal_mode=WAL")
     
-    conn.commit()
-    conn.close()
+        # User sessions table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                thread_id TEXT PRIMARY KEY,
+                state_data BLOB NOT NULL,
+                snapshot_data BLOB,
+                created_at INTEGER NOT NULL,
+                updated_at INTEGER NOT NULL
+            )
+        """)
+        _add_column_if_missing(cursor, "sessions", "snapshot_data", "BLOB")
+    
+        # Transactions table (for querying; the full record lives in the encrypted
+        # session state, so older databases just leave encrypted_data NULL)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS transactions (
+                id TEXT PRIMARY KEY,
+                thread_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                description TEXT NOT NULL,
+                amount REAL NOT NULL,
+                account_from TEXT NOT NULL,
+                account_to TEXT NOT NULL,
+                category TEXT NOT NULL,
+                subcategory TEXT,
+                cost_basis REAL,
+                asset_type TEXT,
+                quantity REAL,
+                FOREIGN KEY (thread_id) REFERENCES sessions(thread_id)
+            )
+        """)
+    
+        # Accounts table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS accounts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                thread_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                type TEXT NOT NULL,
+                balance REAL NOT NULL,
+                currency TEXT DEFAULT 'USD',
+                FOREIGN KEY (thread_id) REFERENCES sessions(thread_id),
+                UNIQUE(thread_id, name)
+            )
+        """)
+    
+        # Range scans for per-thread date windows (monthly charts, exports) and
+        # newest-first keyset paging (SQLite scans it in reverse for ... DESC);
+        # it supersedes the earlier (thread_id, timestamp) index
+        cursor.execute("DROP INDEX IF EXISTS idx_tx_thread_ts")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tx_thread_ts_id ON transactions(thread_id, timestamp, id)")
+        # Covers the YTD income/expense sums, so snapshots never touch the table
+        cursor.execute("DROP INDEX IF EXISTS idx_tx_thread_cat")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tx_thread_cat_amt ON transactions(thread_id, category, timestamp, amount)")
+    
+        conn.commit()
 
 
 @asynccontextmanager
@@ -93,12 +274,16 @@ async def lifespan(app: FastAPI):
     """Startup and shutdown events."""
     init_db()
     yield
+    await close_http_client()
+    await close_checkpointer()
+    close_db_pool()
 
 
 app = FastAPI(
     title="Personal Accountant API",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # CORS for frontend
@@ -123,73 +308,261 @@ class SyncRequest(BaseModel):
     accounts: Dict[str, Any]
 
 
-def encrypt_data(data: str) -> str:
-    """Encrypt data using Fernet."""
-    if fernet:
-        return fernet.encrypt(data.encode()).decode()
+def encrypt_data(data: bytes) -> bytes:
+    """Encrypt data with AES-GCM, returning the 12-byte nonce + ciphertext."""
+    if aesgcm:
+        nonce = os.urandom(12)
+        return nonce + aesgcm.encrypt(nonce, data, None)
     return data
 
 
-def decrypt_data(data: str) -> str:
-    """Decrypt data using Fernet."""
-    if fernet:
-        return fernet.decrypt(data.encode()).decode()
+def decrypt_data(data: Union[str, bytes]) -> Union[str, bytes]:
+    """Decrypt data written by encrypt_data.
+    
+    Text values predate AES-GCM and are Fernet tokens (or plaintext JSON
+    when no key is configured); raw bytes are AES-GCM nonce + ciphertext.
+    """
+    if isinstance(data, str):
+        if fernet:
+            return fernet.decrypt(data.encode())
+        return data
+    if aesgcm:
+        return aesgcm.decrypt(data[:12], data[12:], None)
     return data
 
 
-def save_state(thread_id: str, state: Dict):
-    """Save state to SQLite."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+def _dirty_transactions(state: Dict) -> List[Dict]:
+    """Transactions that still need writing to the transactions table.
+    
+    States saved before dirty tracking existed have no `dirty_tx_ids`, so
+    every transaction is written once. New transactions are always appended,
+    so the scan walks backwards and stops once every dirty id is found.
+    """
+    transactions = state.get("transactions", [])
+    dirty_ids = state.get("dirty_tx_ids")
+    if dirty_ids is None:
+        return transactions
+    
+    pending = set(dirty_ids)
+    dirty = []
+    for tx in reversed(transactions):
+        if not pending:
+            break
+        if tx["id"] in pending:
+            pending.discard(tx["id"])
+            dirty.append(tx)
+    dirty.reverse()
+    return dirty
+
+
+# Decrypted state JSON by thread_id, tagged with the sessions.updated_at it
+# matches. Kept serialized so every load parses its own private copy:
+# concurrent requests on one thread never share mutable state.
+_state_cache: "OrderedDict[str, Tuple[str, Union[str, bytes]]]" = OrderedDict()
+_state_cache_lock = threading.Lock()
+
+
+def _cache_state(thread_id: str, updated_at: str, state_json: Union[str, bytes]):
+    """Remember a state's JSON as current for the given updated_at, evicting the LRU."""
+    with _state_cache_lock:
+        _state_cache[thread_id] = (updated_at, state_json)
+        _state_cache.move_to_end(thread_id)
+        while len(_state_cache) > STATE_CACHE_SIZE:
+            _state_cache.popitem(last=False)
+
+
+def _get_cached_state(thread_id: str, updated_at: str) -> Optional[Union[str, bytes]]:
+    """Return the cached state JSON if it is still the stored version."""
+    with _state_cache_lock:
+        entry = _state_cache.get(thread_id)
+        if entry is None or entry[0] != updated_at:
+            return None
+        _state_cache.move_to_end(thread_id)
+        return entry[1]
+
+
+def _state_summary(state: Dict) -> Dict:
+    """The parts of a state /state reports, stored beside the full blob."""
+    return {
+        "snapshot": state.get("snapshot"),
+        "snapshot_dirty": state.get("snapshot_dirty", True),
+        "snapshot_year": state.get("snapshot_year"),
+        "user_profile": state.get("user_profile"),
+        # Returned to clients as-is, so without the agent's bookkeeping keys
+        "accounts": {name: public_record(acc) for name, acc in state.get("accounts", {}).items()},
+        "transaction_count": len(state.get("transactions", []))
+    }
+
+
+def _write_state(cursor: sqlite3.Cursor, thread_id: str, state: Dict) -> Tuple[str, bytes]:
+    """Write a state's session row, new transactions and accounts.
     
-    state_json = json.dumps(state)
+    Runs inside the caller's transaction; returns the new updated_at and the
+    state JSON that was stored.
+    """
+    # The stored blob never carries pending writes; they land below
+    state_json = orjson.dumps({**state, "dirty_tx_ids": []})
     encrypted_state = encrypt_data(state_json)
-    now = datetime.utcnow().isoformat()
+    encrypted_summary = encrypt_data(orjson.dumps(_state_summary(state)))
+    # Epoch nanoseconds; sessions saved before this keep ISO text until rewritten
+    now = time.time_ns()
     
-    cursor.execute("""
-        INSERT OR REPLACE INTO sessions (thread_id, state_data, created_at, updated_at)
-        VALUES (?, ?, COALESCE((SELECT created_at FROM sessions WHERE thread_id = ?), ?), ?)
-    """, (thread_id, encrypted_state, thread_id, now, now))
+    cursor.execute(SQL_UPSERT_SESSION, (thread_id, encrypted_state, encrypted_summary, thread_id, now, now))
     
-    # Save transactions
-    for tx in state.get("transactions", []):
-        tx_json = json.dumps(tx)
-        encrypted_tx = encrypt_data(tx_json)
-        cursor.execute("""
-            INSERT OR REPLACE INTO transactions 
-            (id, thread_id, timestamp, description, amount, account_from, account_to, 
-             category, subcategory, cost_basis, asset_type, quantity, encrypted_data)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            tx["id"], thread_id, tx["timestamp"], tx["description"], tx["amount"],
-            tx["account_from"], tx["account_to"], tx["category"],
-            tx.get("subcategory"), tx.get("cost_basis"), tx.get("asset_type"),
-            tx.get("quantity"), encrypted_tx
-        ))
+    # Save only new transactions; existing rows never change
+    tx_rows = [(
+        tx["id"], thread_id, tx["timestamp"], tx["description"], tx["amount"],
+        tx["account_from"], tx["account_to"], tx["category"],
+        tx.get("subcategory"), tx.get("cost_basis"), tx.get("asset_type"),
+        tx.get("quantity")
+    ) for tx in _dirty_transactions(state)]
+    cursor.executemany(SQL_UPSERT_TRANSACTION, tx_rows)
     
     # Save accounts
-    for name, acc in state.get("accounts", {}).items():
-        cursor.execute("""
-            INSERT OR REPLACE INTO accounts (thread_id, name, type, balance, currency)
-            VALUES (?, ?, ?, ?, ?)
-        """, (thread_id, name, acc["type"], acc["balance"], acc.get("currency", "USD")))
+    acc_rows = [(thread_id, name, acc["type"], acc["balance"], acc.get("currency", "USD"))
+                for name, acc in state.get("accounts", {}).items()]
+    cursor.executemany(SQL_UPSERT_ACCOUNT, acc_rows)
+    
+    return str(now), state_json
+
+
+def _state_written(thread_id: str, state: Dict, updated_at: str, state_json: bytes):
+    """Bookkeeping once a _write_state transaction has committed."""
+    state["dirty_tx_ids"] = []
+    _cache_state(thread_id, updated_at, state_json)
+
+
+def save_state(thread_id: str, state: Dict) -> str:
+    """Save state to SQLite, returning the session's new updated_at."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        
+        # Write everything in a single transaction
+        cursor.execute("BEGIN")
+        updated_at, state_json = _write_state(cursor, thread_id, state)
+        conn.commit()
+    
+    _state_written(thread_id, state, updated_at, state_json)
+    return updated_at
+
+
+TX_FIELDS = (
+    "id", "timestamp", "description", "amount", "account_from", "account_to",
+    "category", "subcategory", "cost_basis", "asset_type", "quantity"
+)
+TX_REQUIRED_FIELDS = TX_FIELDS[:7]
+
+
+def _synced_transaction(tx: Dict) -> Dict:
+    """Validate a client transaction and normalize it to the stored fields."""
+    missing = [field for field in TX_REQUIRED_FIELDS if tx.get(field) is None]
+    if missing:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Transaction {tx.get('id')!r} is missing: {', '.join(missing)}"
+        )
+    return {field: tx.get(field) for field in TX_FIELDS}
+
+
+def _synced_account(name: str, acc: Dict) -> Dict:
+    """Validate a client account; derived keys are dropped, never trusted."""
+    if acc.get("type") is None or not isinstance(acc.get("balance"), (int, float)):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Account {name!r} needs a type and a numeric balance"
+        )
+    return public_record(acc)
+
+
+def _ytd_totals(cursor: sqlite3.Cursor, thread_id: str, year: int) -> Tuple[float, float]:
+    """Sum a year's income and expenses from the covering category index."""
+    # One range scan per category over idx_tx_thread_cat_amt, never the table
+    cursor.execute(SQL_YTD_TOTALS, (thread_id, f"{year:04d}-01-01", f"{year + 1:04d}-01-01"))
+    totals = dict(cursor.fetchall())
+    return totals.get("income", 0.0), totals.get("expense", 0.0)
+
+
+def query_ytd_totals(thread_id: str, year: int) -> Tuple[float, float]:
+    """Sum a year's income and expenses (see _ytd_totals) on a pooled connection."""
+    with get_db() as conn:
+        return _ytd_totals(conn.cursor(), thread_id, year)
+
+
+def _table_matches_ledger(cursor: sqlite3.Cursor, thread_id: str, transaction_count: int) -> bool:
+    """Whether the transactions table holds exactly a state's ledger.
+    
+    Every ledger row is persisted, so equal counts mean equal sets. The table
+    runs ahead when a save from an older copy of the state drops rows that a
+    /sync committed; until a retry re-adds them, YTD totals must come from the
+    ledger so they agree with transaction_count and the running totals.
+    """
+    cursor.execute(SQL_COUNT_TRANSACTIONS, (thread_id,))
+    return cursor.fetchone()[0] == transaction_count
+
+
+def query_ytd_source(
+    thread_id: str,
+    transaction_count: int
+) -> Optional[Callable[[int], Tuple[float, float]]]:
+    """calculate_snapshot's ytd_totals backed by SQL, or None to scan the ledger."""
+    with get_db() as conn:
+        if not _table_matches_ledger(conn.cursor(), thread_id, transaction_count):
+            return None
+    return lambda year: query_ytd_totals(thread_id, year)
+
+
+def load_state_summary(thread_id: str) -> Optional[Dict]:
+    """Load the stored state summary, without touching the full state blob."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute(SQL_SELECT_SESSION_SUMMARY, (thread_id,))
+        row = cursor.fetchone()
+    
+    if row and row[0] is not None:
+        return _loads(decrypt_data(row[0]))
+    return None
+
+
+def load_session_updated_at(thread_id: str) -> Optional[str]:
+    """Return the stored session's updated_at (as text), or None if there is none."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute(SQL_SELECT_SESSION_UPDATED_AT, (thread_id,))
+        row = cursor.fetchone()
     
-    conn.commit()
-    conn.close()
+    return str(row[0]) if row else None
 
 
 def load_state(thread_id: str) -> Optional[Dict]:
-    """Load state from SQLite."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+    """Load state from SQLite.
     
-    cursor.execute("SELECT state_data FROM sessions WHERE thread_id = ?", (thread_id,))
-    row = cursor.fetchone()
-    conn.close()
+    While its updated_at still matches, the state is parsed from the cached
+    JSON, skipping the read and decrypt of the full blob.
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute(SQL_SELECT_SESSION_UPDATED_AT, (thread_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        
+        # Compared as text: columns created before the switch to integer
+        # timestamps hand the same value back as a string
+        updated_at = str(row[0])
+        state_json = _get_cached_state(thread_id, updated_at)
+        if state_json is not None:
+            return _loads(state_json)
+        
+        cursor.execute(SQL_SELECT_SESSION_STATE, (thread_id,))
+        row = cursor.fetchone()
     
     if row:
         decrypted = decrypt_data(row[0])
-        return json.loads(decrypted)
+        _cache_state(thread_id, updated_at, decrypted)
+        return _loads(decrypted)
     return None
 
 
@@ -230,7 +603,7 @@ async def chat(request: MessageRequest):
     user_message = request.message
     
     # Load or create state
-    state = load_state(thread_id)
+    state = await asyncio.to_thread(load_state, thread_id)
     if not state:
         state = create_default_state()
         state["thread_id"] = thread_id
@@ -249,7 +622,7 @@ async def chat(request: MessageRequest):
         result = await graph.ainvoke(state, config)
         
         # Save updated state
-        save_state(thread_id, result)
+        await asyncio.to_thread(save_state, thread_id, result)
         
         # Get last assistant message
         messages = result.get("messages", [])
@@ -276,7 +649,7 @@ async def chat_with_file(
     file_data, file_type = await process_file_for_vision(file)
     
     # Load or create state
-    state = load_state(thread_id)
+    state = await asyncio.to_thread(load_state, thread_id)
     if not state:
         state = create_default_state()
         state["thread_id"] = thread_id
@@ -309,7 +682,7 @@ async def chat_with_file(
         result = await graph.ainvoke(state, config)
         
         # Save updated state
-        save_state(thread_id, result)
+        await asyncio.to_thread(save_state, thread_id, result)
         
         # Get last assistant message
         messages = result.get("messages", [])
@@ -326,80 +699,105 @@ async def chat_with_file(
 
 
 @app.get("/state/{thread_id}")
-async def get_state(thread_id: str):
+def get_state(thread_id: str):
     """Get current state for a thread."""
-    state = load_state(thread_id)
-    if not state:
-        state = create_default_state()
-        state["thread_id"] = thread_id
-    
-    # Calculate fresh snapshot
-    state["snapshot"] = calculate_snapshot(state)
+    # The summary saved with the state normally carries an up-to-date
+    # snapshot. It can't stand in for a ledger of transactions without
+    # accounts, though: the empty-ledger check looks at transactions.
+    # A rebuild (year rollover) sums YTD in SQL, which the summary needs
+    # since it has no transactions to scan
+    summary = load_state_summary(thread_id)
+    ytd_totals = None
+    if summary is not None and (summary["accounts"] or not summary["transaction_count"]):
+        ytd_totals = query_ytd_source(thread_id, summary["transaction_count"])
+    
+    if ytd_totals is not None:
+        # Refresh the derived fields
+        summary["snapshot"] = calculate_snapshot(summary, ytd_totals)
+    else:
+        state = load_state(thread_id)
+        if not state:
+            state = create_default_state()
+            state["thread_id"] = thread_id
+        
+        # Calculate fresh snapshot
+        state["snapshot"] = calculate_snapshot(
+            state, query_ytd_source(thread_id, len(state["transactions"]))
+        )
+        summary = _state_summary(state)
     
     return {
         "thread_id": thread_id,
-        "snapshot": state.get("snapshot", {}),
-        "user_profile": state.get("user_profile"),
-        "accounts": state.get("accounts", {}),
-        "transaction_count": len(state.get("transactions", [])),
-        "setup_complete": state.get("user_profile", {}).get("setup_complete", False) if state.get("user_profile") else False
+        "snapshot": summary.get("snapshot", {}),
+        "user_profile": summary.get("user_profile"),
+        # A rebuild annotates the accounts it walked with their asset class
+        "accounts": {name: public_record(acc) for name, acc in summary.get("accounts", {}).items()},
+        "transaction_count": summary["transaction_count"],
+        "setup_complete": summary.get("user_profile", {}).get("setup_complete", False) if summary.get("user_profile") else False
     }
 
 
+def _encode_page_cursor(timestamp: str, tx_id: str) -> str:
+    """Opaque /transactions cursor for the position after (timestamp, id)."""
+    return base64.urlsafe_b64encode(f"{timestamp}|{tx_id}".encode()).decode()
+
+
+def _decode_page_cursor(cursor: str) -> Tuple[str, str]:
+    """Inverse of _encode_page_cursor; rejects malformed cursors with a 400."""
+    try:
+        timestamp, tx_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return timestamp, tx_id
+
+
 @app.get("/transactions/{thread_id}")
-async def get_transactions(thread_id: str, limit: int = 100, offset: int = 0):
-    """Get transactions for a thread."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, timestamp, description, amount, account_from, account_to, 
-               category, subcategory, cost_basis, asset_type, quantity
-        FROM transactions 
-        WHERE thread_id = ?
-        ORDER BY timestamp DESC
-        LIMIT ? OFFSET ?
-    """, (thread_id, limit, offset))
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
-    transactions = []
-    for row in rows:
-        transactions.append({
-            "id": row[0],
-            "timestamp": row[1],
-            "description": row[2],
-            "amount": row[3],
-            "account_from": row[4],
-            "account_to": row[5],
-            "category": row[6],
-            "subcategory": row[7],
-            "cost_basis": row[8],
-            "asset_type": row[9],
-            "quantity": row[10]
-        })
-    
-    return {"transactions": transactions, "count": len(transactions)}
+def get_transactions(
+    thread_id: str,
+    limit: int = 100,
+    offset: int = 0,
+    before_ts: Optional[str] = None,
+    cursor: Optional[str] = None
+):
+    """Get transactions for a thread, newest first.
+    
+    Pass the previous page's `next_cursor` as `cursor` to page by key instead
+    of `offset`, which still has to step over every skipped row. `before_ts`
+    pages by timestamp alone. `offset` is ignored when either key is given.
+    """
+    if cursor is not None:
+        sql = SQL_SELECT_TRANSACTIONS_AFTER_CURSOR
+        params = (thread_id, *_decode_page_cursor(cursor), limit)
+    elif before_ts is not None:
+        sql = SQL_SELECT_TRANSACTIONS_BEFORE_TS
+        params = (thread_id, before_ts, limit)
+    else:
+        sql = SQL_SELECT_TRANSACTIONS_PAGE
+        params = (thread_id, limit, offset)
+    
+    with get_db() as conn:
+        # Every form walks idx_tx_thread_ts_id backwards; no separate sort is needed
+        rows = conn.execute(sql, params).fetchall()
+    
+    transactions = [dict(zip(TX_FIELDS, row)) for row in rows]
+    # A full page may have more after it (limit=0 or an empty page never does)
+    next_cursor = None
+    if rows and len(rows) == limit:
+        next_cursor = _encode_page_cursor(rows[-1][1], rows[-1][0])
+    
+    # Rows are plain JSON types: skip FastAPI's jsonable_encoder pass
+    return ORJSONResponse({
+        "transactions": transactions,
+        "count": len(transactions),
+        "next_cursor": next_cursor
+    })
 
 
-@app.get("/export/{thread_id}")
-async def export_csv_endpoint(thread_id: str):
-    """Export all transactions as CSV."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, timestamp, description, amount, account_from, account_to, 
-               category, subcategory, cost_basis, asset_type, quantity
-        FROM transactions 
-        WHERE thread_id = ?
-        ORDER BY timestamp DESC
-    """, (thread_id,))
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
+CSV_EXPORT_BATCH_SIZE = 1000
+
+
+def _iter_csv_export(thread_id: str):
+    """Yield the CSV export in encoded chunks, streaming rows from the cursor."""
     output = io.StringIO()
     writer = csv.writer(output)
     writer.writerow([
@@ -407,20 +805,39 @@ async def export_csv_endpoint(thread_id: str):
         "Category", "Subcategory", "Cost Basis", "Asset Type", "Quantity"
     ])
     
-    for row in rows:
-        writer.writerow(row)
-    
-    output.seek(0)
+    # A dedicated connection: the download can take as long as the client
+    # likes without holding one of the pooled connections hostage
+    conn = _connect()
+    try:
+        cursor = conn.execute(SQL_EXPORT_TRANSACTIONS, (thread_id,))
+        while True:
+            rows = cursor.fetchmany(CSV_EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            writer.writerows(rows)
+            yield output.getvalue().encode()
+            output.seek(0)
+            output.truncate()
+    finally:
+        conn.close()
     
+    # Header only (or anything left unflushed)
+    if output.tell():
+        yield output.getvalue().encode()
+
+
+@app.get("/export/{thread_id}")
+async def export_csv_endpoint(thread_id: str):
+    """Export all transactions as CSV."""
     return StreamingResponse(
-        io.BytesIO(output.getvalue().encode()),
+        _iter_csv_export(thread_id),
         media_type="text/csv",
         headers={"Content-Disposition": f"attachment; filename=ledger_{thread_id}_{datetime.now().strftime('%Y%m%d')}.csv"}
     )
 
 
 @app.post("/sync")
-async def sync_data(request: SyncRequest):
+def sync_data(request: SyncRequest):
     """Sync offline data to server."""
     thread_id = request.thread_id
     
@@ -430,22 +847,50 @@ async def sync_data(request: SyncRequest):
         state = create_default_state()
         state["thread_id"] = thread_id
     
-    # Merge transactions (avoid duplicates)
-    existing_ids = {tx["id"] for tx in state.get("transactions", [])}
+    # Validate and build everything before touching the DB, so a bad payload
+    # can't leave rows in the table that never reached the state. Dedup is
+    # against the state's ledger: a retry re-adds anything a failed or
+    # overwritten save lost, while INSERT OR IGNORE keeps the table write idempotent.
+    known_ids = {tx["id"] for tx in state["transactions"]}
+    new_transactions = []
     for tx in request.transactions:
-        if tx["id"] not in existing_ids:
-            state["transactions"].append(tx)
+        if tx.get("id") not in known_ids:
+            new_transactions.append(_synced_transaction(tx))
+            known_ids.add(tx["id"])
     
     # Merge accounts (take latest balances)
-    for name, acc in request.accounts.items():
-        state["accounts"][name] = acc
+    accounts = {name: _synced_account(name, acc) for name, acc in request.accounts.items()}
     
-    # Recalculate snapshot
-    state["snapshot"] = calculate_snapshot(state)
+    state["transactions"].extend(new_transactions)
+    state["accounts"].update(accounts)
     state["last_updated"] = datetime.utcnow().isoformat()
     
-    # Save
-    save_state(thread_id, state)
+    tx_rows = [(
+        tx["id"], thread_id, tx["timestamp"], tx["description"], tx["amount"],
+        tx["account_from"], tx["account_to"], tx["category"],
+        tx["subcategory"], tx["cost_basis"], tx["asset_type"], tx["quantity"]
+    ) for tx in new_transactions]
+    
+    # The synced rows and the session that lists them commit together
+    with get_db() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.executemany(SQL_INSERT_TRANSACTION_IGNORE, tx_rows)
+        
+        # Recalculate snapshot (merged rows bypassed the agent's running totals);
+        # YTD totals come from SQL rather than a scan of the whole ledger,
+        # unless the table has rows the ledger lost
+        state["snapshot_dirty"] = True
+        ytd_totals = None
+        if _table_matches_ledger(cursor, thread_id, len(state["transactions"])):
+            ytd_totals = lambda year: _ytd_totals(cursor, thread_id, year)
+        state["snapshot"] = calculate_snapshot(state, ytd_totals)
+        
+        updated_at, state_json = _write_state(cursor, thread_id, state)
+        conn.commit()
+    
+    _state_written(thread_id, state, updated_at, state_json)
     
     return {
         "success": True,
@@ -454,50 +899,30 @@ async def sync_data(request: SyncRequest):
     }
 
 
+MONTH_NAMES = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", 
+               "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
 @app.get("/monthly-data/{thread_id}")
-async def get_monthly_data(thread_id: str, year: Optional[int] = None):
+def get_monthly_data(thread_id: str, year: Optional[int] = None):
     """Get monthly income/expense data for charts."""
     if not year:
         year = datetime.now().year
     
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    # Get monthly totals
-    cursor.execute("""
-        SELECT 
-            strftime('%m', timestamp) as month,
-            category,
-            SUM(amount) as total
-        FROM transactions 
-        WHERE thread_id = ? AND strftime('%Y', timestamp) = ?
-        GROUP BY month, category
-        ORDER BY month
-    """, (thread_id, str(year)))
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
-    monthly_data = {str(i).zfill(2): {"income": 0, "expense": 0} for i in range(1, 13)}
-    
-    for row in rows:
-        month, category, total = row
-        if category == "income":
-            monthly_data[month]["income"] = total
-        elif category == "expense":
-            monthly_data[month]["expense"] = total
-    
-    result = []
-    month_names = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", 
-                   "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
-    
-    for i, name in enumerate(month_names, 1):
-        month_key = str(i).zfill(2)
-        result.append({
-            "month": name,
-            "income": monthly_data[month_key]["income"],
-            "expenses": monthly_data[month_key]["expense"]
-        })
+    with get_db() as conn:
+        cursor = conn.cursor()
+        
+        # Pivot income/expense per month in SQL
+        cursor.execute(SQL_MONTHLY_TOTALS, (thread_id, f"{year:04d}-01-01", f"{year + 1:04d}-01-01"))
+    
+        rows = cursor.fetchall()
+    
+    result = [{"month": name, "income": 0, "expenses": 0} for name in MONTH_NAMES]
+    
+    for month, income, expenses in rows:
+        entry = result[month - 1]
+        entry["income"] = income
+        entry["expenses"] = expenses
     
     return {"data": result, "year": year}
 
@@ -508,16 +933,35 @@ async def websocket_endpoint(websocket: WebSocket, thread_id: str):
     """WebSocket for real-time chat."""
     await websocket.accept()
     
+    # The state stays in memory between messages for as long as the stored
+    # session is the version this connection last loaded or saved
+    state: Optional[Dict] = None
+    loaded_at: Optional[str] = None
+    save_task: Optional[asyncio.Task] = None
+    
+    async def wait_for_save():
+        nonlocal loaded_at
+        if save_task is not None:
+            loaded_at = await save_task
+    
     try:
         while True:
             data = await websocket.receive_text()
-            message_data = json.loads(data)
+            message_data = _loads(data)
+            
+            # The previous save must finish before the state is mutated again
+            await wait_for_save()
+            save_task = None
             
-            # Process message
-            state = load_state(thread_id)
-            if not state:
-                state = create_default_state()
-                state["thread_id"] = thread_id
+            # Another tab or device may have saved this thread since; if so,
+            # pick up its version instead of overwriting it
+            stored_at = await asyncio.to_thread(load_session_updated_at, thread_id)
+            if state is None or stored_at != loaded_at:
+                state = await asyncio.to_thread(load_state, thread_id)
+                if not state:
+                    state = create_default_state()
+                    state["thread_id"] = thread_id
+                loaded_at = stored_at
             
             state["messages"].append({
                 "role": "user",
@@ -526,21 +970,24 @@ async def websocket_endpoint(websocket: WebSocket, thread_id: str):
             
             config = {"configurable": {"thread_id": thread_id}}
             graph = await get_compiled_graph()
-            result = await graph.ainvoke(state, config)
+            state = await graph.ainvoke(state, config)
             
-            save_state(thread_id, result)
+            # Persist in the background so the reply isn't held up by the write
+            save_task = asyncio.create_task(asyncio.to_thread(save_state, thread_id, state))
             
-            messages = result.get("messages", [])
+            messages = state.get("messages", [])
             last_message = messages[-1] if messages else {"role": "assistant", "content": "No response"}
             
-            await websocket.send_json({
+            await websocket.send_text(_dumps({
                 "response": last_message.get("content", ""),
-                "snapshot": result.get("snapshot", {}),
-                "setup_complete": result.get("user_profile", {}).get("setup_complete", False)
-            })
+                "snapshot": state.get("snapshot", {}),
+                "setup_complete": state.get("user_profile", {}).get("setup_complete", False)
+            }))
             
     except WebSocketDisconnect:
         pass
+    finally:
+        await wait_for_save()
 
 
 if __name__ == "__main__":